@@ -16,11 +16,19 @@ class Settings(BaseSettings):
         default="http://127.0.0.1:8080",
         description="URL of the llama-server backend",
     )
+    upstream_http2: bool = Field(
+        default=False,
+        description="Use HTTP/2 to the backend (falls back to HTTP/1.1 if the health check fails)",
+    )
 
     # Concurrency control
     max_concurrent_requests: int = Field(
         default=4,
-        description="Maximum concurrent inference requests (tune based on RAM)",
+        description="Maximum concurrent inference requests (tune based on RAM; 0 = delegate limiting to llama-server)",
+    )
+    max_queue_depth: int = Field(
+        default=64,
+        description="Maximum requests waiting for a slot; beyond this new requests get 503",
     )
     request_timeout: float = Field(
         default=300.0,
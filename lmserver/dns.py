@@ -40,16 +40,18 @@ async def register_dns() -> bool:
                 json=payload,
             )
             response.raise_for_status()
-            full_domain = f"{settings.dns_service_name}.{settings.dns_domain_base}"
             logger.info(
-                f"Registered with DNS: {full_domain} -> :{settings.port}"
+                "Registered with DNS: %s.%s -> :%d",
+                settings.dns_service_name,
+                settings.dns_domain_base,
+                settings.port,
             )
             return True
     except httpx.HTTPStatusError as e:
-        logger.error(f"DNS registration failed with status {e.response.status_code}: {e.response.text}")
+        logger.error("DNS registration failed with status %d: %s", e.response.status_code, e.response.text)
         return False
     except httpx.RequestError as e:
-        logger.warning(f"DNS registration failed (network error): {e}")
+        logger.warning("DNS registration failed (network error): %s", e)
         logger.warning("Service will continue without DNS registration")
         return False
 
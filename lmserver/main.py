@@ -1,59 +1,132 @@
 """FastAPI application for LMServer - OpenAI-compatible local LLM gateway."""
 
+import asyncio
 import logging
+import logging.config
+import time
 from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
 from .config import settings
 from .dns import register_dns, deregister_dns
-from .proxy import proxy, get_semaphore
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+from .proxy import proxy, get_admission, create_client, QueueFullError
+
+# Configure logging: a single root handler with one shared formatter
+logging.config.dictConfig(
+    {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {
+            "default": {
+                "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            },
+        },
+        "handlers": {
+            "default": {
+                "class": "logging.StreamHandler",
+                "formatter": "default",
+            },
+        },
+        "root": {"level": "INFO", "handlers": ["default"]},
+    }
 )
 logger = logging.getLogger(__name__)
 
+# Settings read on the request hot path, resolved once at import
+_DEFAULT_MODEL = settings.default_model
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan: startup and shutdown hooks."""
     # Startup
-    logger.info(f"Starting LMServer v0.1.0")
-    logger.info(f"Backend: {settings.llama_server_url}")
-    logger.info(f"Max concurrent requests: {settings.max_concurrent_requests}")
-
-    # Initialize semaphore
-    get_semaphore()
-
-    # Register with DNS
-    await register_dns()
+    logger.info("Starting LMServer v0.1.0")
+    logger.info("Backend: %s", settings.llama_server_url)
+    logger.info("Max concurrent requests: %d", settings.max_concurrent_requests)
+
+    # Initialize admission controller
+    get_admission()
+
+    # Shared upstream client so connections are pooled across requests
+    app.state.llama_client = create_client()
+    app.state.llama_client_h2 = None
+    if settings.upstream_http2:
+        # Keep the HTTP/1.1 client around in case the upstream can't do HTTP/2
+        app.state.llama_client_h2 = create_client(http2=True)
+        proxy.client = app.state.llama_client_h2
+        proxy.http1_client = app.state.llama_client
+    else:
+        proxy.client = app.state.llama_client
+
+    # Prewarm the pool in the background so the first inference skips connect
+    warmup_task = asyncio.create_task(proxy.warm_up(settings.max_concurrent_requests))
+    app.state.warmup_task = warmup_task
+
+    # Register with DNS in the background so the port binds immediately;
+    # /health reports ready once registration has finished
+    app.state.ready = False
+    dns_task = asyncio.create_task(register_dns())
+    dns_task.add_done_callback(lambda _: setattr(app.state, "ready", True))
+    app.state.dns_task = dns_task
 
     yield
 
     # Shutdown
     logger.info("Shutting down LMServer")
+    for task in (warmup_task, dns_task):
+        if not task.done():
+            task.cancel()
+        # A failed background task must not skip the cleanup below
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning("Background startup task failed: %s", e)
+    await app.state.llama_client.aclose()
+    if app.state.llama_client_h2 is not None:
+        await app.state.llama_client_h2.aclose()
     await deregister_dns()
 
 
+class _ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (FastAPI's ORJSONResponse is deprecated)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
 app = FastAPI(
     title="LMServer",
     description="OpenAI-compatible local LLM gateway for Tailscale networks",
     version="0.1.0",
     lifespan=lifespan,
+    default_response_class=_ORJSONResponse,
 )
 
 
 # --- Health endpoints ---
 
 
+@app.get("/health/live")
+async def health_live():
+    """Liveness check: the process is up and serving requests."""
+    return {"status": "ok"}
+
+
 @app.get("/health")
-async def health():
-    """Health check endpoint."""
+async def health(request: Request):
+    """Readiness check endpoint with backend status."""
+    if not request.app.state.ready:
+        return _ORJSONResponse(status_code=503, content={"status": "starting"})
+
     backend_health = await proxy.health_check()
     return {
         "status": "ok",
@@ -75,6 +148,7 @@ async def root():
             "chat_completions": "/v1/chat/completions",
             "models": "/v1/models",
             "health": "/health",
+            "health_live": "/health/live",
         },
     }
 
@@ -82,14 +156,31 @@ async def root():
 # --- OpenAI-compatible endpoints ---
 
 
-class ChatMessage(BaseModel):
-    role: str
-    content: str
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always runs `on_close` once the ASGI call ends.
+
+    Covers failures before the body iterator is first advanced (e.g. the
+    client is gone when the response start is sent), where the iterator's
+    own cleanup would never run.
+    """
+
+    def __init__(self, *args, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
 
 
 class ChatCompletionRequest(BaseModel):
+    """Request schema, used for OpenAPI docs only (bodies are passed through)."""
+
     model: str | None = None
-    messages: list[ChatMessage]
+    messages: list[dict[str, Any]]
     temperature: float | None = None
     top_p: float | None = None
     max_tokens: int | None = None
@@ -99,37 +190,84 @@ class ChatCompletionRequest(BaseModel):
         extra = "allow"  # Allow additional OpenAI params
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+@app.post(
+    "/v1/chat/completions",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": ChatCompletionRequest.model_json_schema(),
+                },
+            },
+        },
+    },
+)
+async def chat_completions(request: Request, background_tasks: BackgroundTasks):
     """
     OpenAI-compatible chat completions endpoint.
 
-    Proxies to llama-server with concurrency limiting.
+    Proxies to llama-server with concurrency limiting. The JSON body is
+    forwarded as-is rather than round-tripped through a pydantic model.
     """
-    # Build request body, preserving extra fields
-    request_body = request.model_dump(exclude_none=True)
+    try:
+        request_body = orjson.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Request body must be valid JSON")
+
+    if not isinstance(request_body, dict) or not isinstance(request_body.get("messages"), list):
+        raise HTTPException(status_code=422, detail="'messages' must be a list")
 
     # Set default model if not specified
     if not request_body.get("model"):
-        request_body["model"] = settings.default_model
+        request_body["model"] = _DEFAULT_MODEL
+
+    stream = bool(request_body.get("stream"))
 
     try:
-        if request.stream:
+        if stream:
             # Streaming response
-            return StreamingResponse(
-                proxy.chat_completions_stream(request_body),
+            headers, body = await proxy.chat_completions_stream(request_body)
+            # Measured from the upstream response, like response.elapsed for
+            # non-streaming requests, so queue wait is excluded
+            stream_start = time.monotonic()
+            return _ClosingStreamingResponse(
+                body,
+                on_close=body.aclose,
                 media_type="text/event-stream",
+                headers=headers,
+                background=BackgroundTask(_log_stream_completed, stream_start),
             )
         else:
-            # Non-streaming response
-            result = await proxy.chat_completions(request_body)
-            return JSONResponse(content=result)
+            # Non-streaming response: pass upstream bytes through as-is
+            response = await proxy.chat_completions(request_body)
+            # Logged after the response is sent, off the client-visible path
+            if logger.isEnabledFor(logging.DEBUG):
+                background_tasks.add_task(
+                    logger.debug,
+                    "Inference completed in %.2fs",
+                    response.elapsed.total_seconds(),
+                )
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type="application/json",
+                background=background_tasks,
+            )
 
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="queue full")
     except Exception as e:
-        logger.error(f"Chat completion error: {e}")
+        logger.error("Chat completion error: %s", e)
         raise HTTPException(status_code=502, detail=f"Backend error: {str(e)}")
 
 
+def _log_stream_completed(stream_start: float) -> None:
+    """Background task run once a streamed completion has been sent."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Streamed inference completed in %.2fs", time.monotonic() - stream_start)
+
+
 @app.get("/v1/models")
 async def list_models():
     """List available models (OpenAI-compatible)."""
@@ -146,19 +284,42 @@ async def queue_status():
 
     Useful for merkle project to understand backpressure.
     """
-    sem = get_semaphore()
-    # Semaphore doesn't expose waiters count directly, but we can infer availability
-    available = sem._value if hasattr(sem, "_value") else "unknown"
+    admission = get_admission()
 
     return {
-        "max_concurrent": settings.max_concurrent_requests,
-        "available_slots": available,
+        "max_concurrent": admission.limit,
+        "available_slots": (
+            max(admission.limit - admission.active, 0) if admission.limit > 0 else None
+        ),
+        "active": admission.active,
+        "waiting": admission.waiting,
+        "limit": admission.limit,
+        "max_queue_depth": admission.max_queue_depth,
+        "admitted": admission.admitted,
+        "rejected": admission.rejected,
         "backend_url": settings.llama_server_url,
     }
 
 
 # --- Convenience: raw proxy for other llama-server endpoints ---
 
+# Connection-level headers that must not be forwarded by a proxy, plus Host
+# so httpx sets the right one for the upstream
+_HOP_BY_HOP = frozenset(
+    b"connection keep-alive te trailer transfer-encoding upgrade "
+    b"proxy-authorization proxy-authenticate host".split()
+)
+
+
+def _filter_headers(raw: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+    """Drop hop-by-hop headers from raw (bytes) header pairs."""
+    filtered = []
+    for key, value in raw:
+        key = key.lower()
+        if key not in _HOP_BY_HOP:
+            filtered.append((key, value))
+    return filtered
+
 
 @app.api_route("/v1/{path:path}", methods=["GET", "POST"])
 async def proxy_fallback(path: str, request: Request):
@@ -167,24 +328,40 @@ async def proxy_fallback(path: str, request: Request):
 
     Passes through requests like /v1/embeddings, /v1/completions, etc.
     """
-    import httpx
+    client = proxy.client
+    # Only stream a body if the client sent one; otherwise bodiless GETs
+    # would reach llama-server as empty chunked uploads
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+
+    headers = _filter_headers(request.headers.raw)
+    # The response is relayed raw with its Content-Encoding, so don't let
+    # httpx's default Accept-Encoding get the client a gzip it never asked for
+    if "accept-encoding" not in request.headers:
+        headers.append((b"accept-encoding", b"identity"))
+
+    upstream_request = client.build_request(
+        request.method,
+        f"/v1/{path}",
+        content=request.stream() if has_body else None,
+        headers=headers,
+    )
 
     try:
-        body = await request.body()
-        async with httpx.AsyncClient(timeout=settings.request_timeout) as client:
-            response = await client.request(
-                method=request.method,
-                url=f"{settings.llama_server_url}/v1/{path}",
-                content=body,
-                headers={"Content-Type": "application/json"},
-            )
-            return JSONResponse(
-                content=response.json(),
-                status_code=response.status_code,
-            )
-    except Exception as e:
+        response = await client.send(upstream_request, stream=True)
+    except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=str(e))
 
+    # Body streams through in both directions; the upstream connection is
+    # closed however the response ends, including client disconnects
+    streaming = _ClosingStreamingResponse(
+        response.aiter_raw(),
+        on_close=response.aclose,
+        status_code=response.status_code,
+    )
+    # Upstream headers (including Content-Type) are copied over as raw bytes
+    streaming.raw_headers.extend(_filter_headers(response.headers.raw))
+    return streaming
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -194,5 +371,9 @@ if __name__ == "__main__":
         host=settings.host,
         port=settings.port,
         reload=False,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        proxy_headers=True,
     )
 
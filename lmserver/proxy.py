@@ -1,128 +1,420 @@
 """Proxy layer to llama-server with concurrency control."""
 
 import asyncio
+import itertools
 import logging
 import time
 from typing import AsyncIterator
 
 import httpx
+import orjson
 
 from .config import settings
 
 logger = logging.getLogger(__name__)
 
-# Semaphore for concurrency limiting
-_inference_semaphore: asyncio.Semaphore | None = None
+# Settings read on hot paths, resolved once at import
+BASE_URL = settings.llama_server_url
+TIMEOUT = settings.request_timeout
 
+# Queue timing is measured on 1 in N chat completion requests
+_TIMING_SAMPLE_RATE = 100
+_timing_counter = itertools.count()
 
-def get_semaphore() -> asyncio.Semaphore:
-    """Get or create the inference semaphore."""
-    global _inference_semaphore
-    if _inference_semaphore is None:
-        _inference_semaphore = asyncio.Semaphore(settings.max_concurrent_requests)
-        logger.info(f"Initialized inference semaphore with max_concurrent={settings.max_concurrent_requests}")
-    return _inference_semaphore
+
+class QueueFullError(Exception):
+    """Raised when the admission queue is at max_queue_depth."""
+
+
+class Admission:
+    """
+    Admission controller limiting concurrent inference requests.
+
+    An explicit counter guarded by a Condition, so the limit can be changed
+    at runtime and active/waiting counts are observable. Once
+    `max_queue_depth` requests are waiting, new ones are rejected.
+    """
+
+    def __init__(self, limit: int, max_queue_depth: int = 64):
+        self.limit = limit
+        self.max_queue_depth = max_queue_depth
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.cond = asyncio.Condition()
+
+    def try_acquire(self) -> bool:
+        """Take a slot without waiting if one is free and nobody is queued."""
+        if self.waiting == 0 and self.active < self.limit:
+            self.active += 1
+            self.admitted += 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        """Wait for a free slot and take it, or raise QueueFullError."""
+        if self.try_acquire():
+            return
+
+        async with self.cond:
+            if self.waiting + self.active >= self.limit + self.max_queue_depth:
+                self.rejected += 1
+                raise QueueFullError("queue full")
+
+            self.waiting += 1
+            try:
+                await self.cond.wait_for(lambda: self.active < self.limit)
+            except asyncio.CancelledError:
+                # A release() may have woken us just before the cancel; pass
+                # the wakeup on so the free slot isn't stranded
+                if self.active < self.limit:
+                    self.cond.notify(1)
+                raise
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+
+    async def release(self) -> None:
+        """Give a slot back and wake one waiter."""
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify(1)
+
+    async def set_limit(self, limit: int) -> None:
+        """Change the concurrency limit, waking waiters if it grew."""
+        async with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    async def __aenter__(self) -> "Admission":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.release()
+
+
+class _NoopAdmission(Admission):
+    """
+    Admission that never waits, for max_concurrent_requests <= 0.
+
+    Limiting is delegated to llama-server itself; only the active count is
+    kept for /v1/queue/status.
+    """
+
+    def __init__(self):
+        super().__init__(limit=0)
+
+    async def acquire(self) -> None:
+        self.active += 1
+        self.admitted += 1
+
+    async def release(self) -> None:
+        self.active -= 1
+
+    async def set_limit(self, limit: int) -> None:
+        pass
+
+
+# Request headers for JSON bodies encoded with orjson
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_STREAM_HEADERS = {**_JSON_HEADERS, "Accept-Encoding": "identity"}
+
+# Upstream headers passed through on streaming responses
+_STREAM_FORWARD_HEADERS = ("content-type", "x-request-id")
+
+# Admission controller for concurrency limiting
+_admission: Admission | None = None
+
+
+def get_admission() -> Admission:
+    """Get or create the inference admission controller."""
+    global _admission
+    if _admission is None:
+        if settings.max_concurrent_requests <= 0:
+            _admission = _NoopAdmission()
+            logger.info("Admission control disabled, delegating limiting to llama-server")
+        else:
+            _admission = Admission(settings.max_concurrent_requests, settings.max_queue_depth)
+            logger.info(
+                "Initialized admission controller with max_concurrent=%d, max_queue_depth=%d",
+                settings.max_concurrent_requests,
+                settings.max_queue_depth,
+            )
+    return _admission
+
+
+def create_client(http2: bool = False) -> httpx.AsyncClient:
+    """
+    Create the shared, pooled HTTP client for llama-server.
+
+    Only reads wait on inference; connect/write/pool waits stay short so
+    health checks don't inherit the long inference timeout. With http2,
+    concurrent streams are multiplexed over a single connection.
+    """
+    return httpx.AsyncClient(
+        base_url=BASE_URL,
+        http2=http2,
+        timeout=httpx.Timeout(
+            connect=5.0,
+            read=TIMEOUT,
+            write=5.0,
+            pool=5.0,
+        ),
+        limits=_client_limits(settings.max_concurrent_requests),
+    )
+
+
+def _client_limits(max_concurrent: int) -> httpx.Limits:
+    """Size the connection pool from the admission limit (unbounded if disabled)."""
+    if max_concurrent <= 0:
+        return httpx.Limits(max_keepalive_connections=None, max_connections=None)
+    return httpx.Limits(
+        max_keepalive_connections=max_concurrent * 2,
+        max_connections=max_concurrent * 4,
+    )
+
+
+class UpstreamStream:
+    """
+    Open upstream streaming response holding an admission slot.
+
+    Iterating yields upstream bytes untouched and closes the stream when
+    done. aclose() is idempotent, so it can also be called unconditionally
+    by the response wrapper to cover streams that were never iterated.
+    """
+
+    def __init__(self, response: httpx.Response, admission: Admission):
+        self.response = response
+        self.admission = admission
+        self._closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in self.response.aiter_raw():
+                yield chunk
+        except httpx.RequestError as e:
+            logger.error("llama-server stream connection error: %s", e)
+            raise
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the upstream response and release the slot (once)."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self.response.aclose()
+        finally:
+            await self.admission.release()
 
 
 class LlamaServerProxy:
     """Async proxy to llama-server backend."""
 
-    def __init__(self):
-        self.base_url = settings.llama_server_url
-        self.timeout = settings.request_timeout
+    def __init__(
+        self,
+        client: httpx.AsyncClient | None = None,
+        http1_client: httpx.AsyncClient | None = None,
+    ):
+        self.default_model = settings.default_model
+        # Shared client, set during app lifespan startup
+        self.client = client
+        # HTTP/1.1 client to fall back to when `client` is an HTTP/2 client
+        self.http1_client = http1_client
+        # /v1/models cache: (fetched_at, data); misses share one upstream call
+        self._models_inflight: asyncio.Task | None = None
+        self._models_cache: tuple[float, dict] | None = None
+        self._models_ttl = 30.0
+        # /health: one upstream call shared by concurrent callers, result
+        # reused for a second
+        self._health_inflight: asyncio.Task | None = None
+        self._health_cache: tuple[float, dict] | None = None
+        self._health_ttl = 1.0
 
     async def health_check(self) -> dict:
-        """Check if llama-server is healthy."""
+        """Check if llama-server is healthy (coalesced and cached briefly)."""
+        if self._health_cache and time.monotonic() - self._health_cache[0] < self._health_ttl:
+            return self._health_cache[1]
+
+        if self._health_inflight is None or self._health_inflight.done():
+            self._health_inflight = asyncio.create_task(self._fetch_health())
+        # Shielded so one caller disconnecting doesn't cancel it for the rest
+        return await asyncio.shield(self._health_inflight)
+
+    async def _fetch_health(self) -> dict:
+        """Query llama-server /health and cache the result."""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/health")
-                return {"status": "ok", "llama_server": response.json()}
+            response = await self.client.get("/health", timeout=5.0)
+            result = {"status": "ok", "llama_server": response.json()}
         except httpx.RequestError as e:
-            return {"status": "error", "error": str(e)}
+            result = {"status": "error", "error": str(e)}
+            if self.http1_client is not None:
+                # Only give up on HTTP/2 if HTTP/1.1 works where it failed;
+                # if both fail the backend is simply down
+                try:
+                    response = await self.http1_client.get("/health", timeout=5.0)
+                except httpx.RequestError:
+                    pass
+                else:
+                    logger.warning("HTTP/2 health check failed (%s), falling back to HTTP/1.1", e)
+                    self.client, self.http1_client = self.http1_client, None
+                    result = {"status": "ok", "llama_server": response.json()}
 
-    async def chat_completions(self, request_body: dict) -> dict:
-        """
-        Proxy a chat completion request to llama-server.
+        self._health_cache = (time.monotonic(), result)
+        return result
 
-        Uses semaphore to limit concurrent requests.
+    async def warm_up(self, connections: int) -> None:
         """
-        semaphore = get_semaphore()
+        Open up to `connections` pooled keep-alive connections to llama-server.
 
-        # Track queue position for observability
-        queue_start = time.monotonic()
-
-        async with semaphore:
-            queue_time = time.monotonic() - queue_start
-            if queue_time > 0.1:  # Log if we had to wait
-                logger.info(f"Request queued for {queue_time:.2f}s before processing")
+        Best effort: failures are logged, never raised.
+        """
+        # Checks HTTP/2 support first, so a backend without it falls back
+        # before real traffic arrives
+        try:
+            await self.health_check()
+        except Exception as e:
+            # e.g. a non-JSON /health body from a fronting proxy
+            logger.warning("Warm-up health check failed: %s", e)
+        results = await asyncio.gather(
+            *(self.client.get("/health", timeout=5.0) for _ in range(max(connections, 1))),
+            return_exceptions=True,
+        )
+        warmed = sum(1 for r in results if not isinstance(r, BaseException))
+        logger.info("Warmed %d/%d upstream connections", warmed, len(results))
 
-            inference_start = time.monotonic()
+    async def chat_completions(self, request_body: dict) -> httpx.Response:
+        """
+        Proxy a chat completion request to llama-server.
 
-            try:
-                async with httpx.AsyncClient(timeout=self.timeout) as client:
-                    response = await client.post(
-                        f"{self.base_url}/v1/chat/completions",
-                        json=request_body,
-                    )
-                    response.raise_for_status()
+        Uses the admission controller to limit concurrent requests. Returns
+        the upstream response so its body can be passed through undecoded.
+        """
+        admission = get_admission()
+        # Encode before taking a slot so the slot only covers upstream I/O
+        content = orjson.dumps(request_body)
 
-                    inference_time = time.monotonic() - inference_start
-                    logger.debug(f"Inference completed in {inference_time:.2f}s")
+        # Track queue position for observability on sampled requests only
+        sample = next(_timing_counter) % _TIMING_SAMPLE_RATE == 0
+        queue_start = time.monotonic() if sample else None
 
-                    return response.json()
+        async with admission:
+            if queue_start is not None:
+                queue_time = time.monotonic() - queue_start
+                # Log if we had to wait
+                if queue_time > 0.1:
+                    logger.info("Request queued for %.2fs before processing", queue_time)
 
-            except httpx.HTTPStatusError as e:
-                logger.error(f"llama-server error: {e.response.status_code} - {e.response.text}")
-                raise
+            try:
+                # post() buffers the full body before the slot is released
+                response = await self.client.post(
+                    "/v1/chat/completions",
+                    content=content,
+                    headers=_JSON_HEADERS,
+                )
             except httpx.RequestError as e:
-                logger.error(f"llama-server connection error: {e}")
+                logger.error("llama-server connection error: %s", e)
                 raise
 
-    async def chat_completions_stream(self, request_body: dict) -> AsyncIterator[bytes]:
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            logger.error("llama-server error: %d - %s", e.response.status_code, e.response.text)
+            raise
+
+        # Inference time (response.elapsed) is logged by the endpoint after
+        # the response has been sent
+        return response
+
+    async def chat_completions_stream(
+        self, request_body: dict
+    ) -> tuple[dict[str, str], UpstreamStream]:
         """
         Proxy a streaming chat completion request to llama-server.
 
-        Yields SSE chunks as they arrive.
+        Opens the upstream stream and returns the headers to forward along
+        with an UpstreamStream yielding raw SSE bytes as they arrive. The
+        admission slot is held until the stream is closed; the caller must
+        make sure UpstreamStream.aclose() runs even if iteration never starts.
         """
-        semaphore = get_semaphore()
+        admission = get_admission()
+        await admission.acquire()
 
-        async with semaphore:
-            try:
-                async with httpx.AsyncClient(timeout=self.timeout) as client:
-                    async with client.stream(
-                        "POST",
-                        f"{self.base_url}/v1/chat/completions",
-                        json=request_body,
-                    ) as response:
-                        response.raise_for_status()
-                        async for chunk in response.aiter_bytes():
-                            yield chunk
-
-            except httpx.HTTPStatusError as e:
-                logger.error(f"llama-server stream error: {e.response.status_code}")
-                raise
-            except httpx.RequestError as e:
-                logger.error(f"llama-server stream connection error: {e}")
-                raise
+        opened = False
+        try:
+            upstream_request = self.client.build_request(
+                "POST",
+                "/v1/chat/completions",
+                content=orjson.dumps(request_body),
+                headers=_STREAM_HEADERS,
+            )
+            response = await self.client.send(upstream_request, stream=True)
+            response.raise_for_status()
+            opened = True
+        except httpx.HTTPStatusError as e:
+            await e.response.aclose()
+            logger.error("llama-server stream error: %d", e.response.status_code)
+            raise
+        except httpx.RequestError as e:
+            logger.error("llama-server stream connection error: %s", e)
+            raise
+        finally:
+            # Once opened, the UpstreamStream owns the slot
+            if not opened:
+                await admission.release()
+
+        headers = {
+            name: response.headers[name]
+            for name in _STREAM_FORWARD_HEADERS
+            if name in response.headers
+        }
+        return headers, UpstreamStream(response, admission)
+
+    def _cached_models(self) -> dict | None:
+        """Return the cached model list if it is still fresh."""
+        if self._models_cache and time.monotonic() - self._models_cache[0] < self._models_ttl:
+            return self._models_cache[1]
+        return None
 
     async def list_models(self) -> dict:
-        """Get list of available models from llama-server."""
+        """Get list of available models from llama-server (cached for a short TTL)."""
+        cached = self._cached_models()
+        if cached is not None:
+            return cached
+
+        # Concurrent misses all get the result of one fetch, success or fallback
+        if self._models_inflight is None or self._models_inflight.done():
+            self._models_inflight = asyncio.create_task(self._fetch_models())
+        return await asyncio.shield(self._models_inflight)
+
+    async def _fetch_models(self) -> dict:
+        """Query llama-server /v1/models, caching successful responses."""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/v1/models")
-                return response.json()
+            response = await self.client.get("/v1/models", timeout=5.0)
+            data = response.json()
         except httpx.RequestError:
-            # Fallback: return configured default model
-            return {
-                "object": "list",
-                "data": [
-                    {
-                        "id": settings.default_model,
-                        "object": "model",
-                        "owned_by": "local",
-                    }
-                ],
-            }
+            return self._fallback_models()
+
+        if response.is_success:
+            self._models_cache = (time.monotonic(), data)
+        return data
+
+    def _fallback_models(self) -> dict:
+        """Model list built from settings, used when llama-server is unreachable."""
+        return {
+            "object": "list",
+            "data": [
+                {
+                    "id": self.default_model,
+                    "object": "model",
+                    "owned_by": "local",
+                }
+            ],
+        }
 
 
 # Singleton proxy instance